@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
+import atexit
+import heapq
 import os
 from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
 from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -12,32 +18,118 @@ load_dotenv()
 MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 MONGODB_DATABASE = os.getenv('MONGODB_DATABASE', 'sensor_db')
 MONGODB_COLLECTION = os.getenv('MONGODB_COLLECTION', 'sensor_readings')
+MONGODB_STATS_COLLECTION = os.getenv('MONGODB_STATS_COLLECTION', 'sensor_stats')
+# Materialized statistics older than this are ignored (3x an hourly schedule)
+MONGODB_STATS_MAX_AGE_HOURS = float(os.getenv('MONGODB_STATS_MAX_AGE_HOURS', '3'))
+MONGODB_BATCH_SIZE = int(os.getenv('MONGODB_BATCH_SIZE', '50'))
 
-def detect_anomalies(days_back=7, sigma_threshold=3):
+MONGODB_INDEX_DAYS = int(os.getenv('MONGODB_INDEX_DAYS', '14'))
+
+# Per-sensor time range lookups, covering the anomaly lookup's value filter
+LOOKUP_INDEX = [('sensor_id', 1), ('timestamp', 1), ('value', 1)]
+
+# Covering index for the stats pipeline: the timestamp range is scanned first and
+# sensor_id/value are read straight from the index keys. It is partial, holding
+# only the last MONGODB_INDEX_DAYS days, and rebuilt by refresh_recent_index
+STATS_INDEX = [('timestamp', 1), ('sensor_id', 1), ('value', 1)]
+STATS_INDEX_NAME = 'recent_readings'
+
+# Server error code for a hint naming an index that is missing or unusable
+BAD_VALUE = 2
+
+# Shared client, created on first use so repeated runs reuse its connection pool
+_client = None
+
+def get_client():
     """
-    Detect anomalies in sensor data using 3-sigma rule
+    Return the shared MongoDB client, creating it on first use
+    
+    Returns:
+        MongoClient: Client that is closed automatically at interpreter exit
+    """
+    global _client
+    if _client is None:
+        _client = MongoClient(MONGODB_URI, maxPoolSize=10)
+        atexit.register(_client.close)
+    return _client
+
+def ensure_indexes(collection):
+    """
+    Create any missing indexes used by the anomaly detection queries, with a
+    single index listing per call
     
     Args:
-        days_back (int): Number of days to look back
-        sigma_threshold (float): Number of standard deviations for threshold
+        collection: MongoDB collection holding the sensor readings
+    
+    Returns:
+        datetime: Cutoff of the partial stats index (see stats_index_hint)
     """
-    # Connect to MongoDB
-    client = MongoClient(MONGODB_URI)
-    db = client[MONGODB_DATABASE]
-    collection = db[MONGODB_COLLECTION]
+    indexes = collection.index_information()
+    if not any(info['key'] == LOOKUP_INDEX for info in indexes.values()):
+        collection.create_index(LOOKUP_INDEX)
     
-    # Calculate date range
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=days_back)
+    # Rebuild the stats index when missing or not the expected partial index
+    # (e.g. created by hand or by an earlier deployment)
+    info = indexes.get(STATS_INDEX_NAME) or {}
+    cutoff = info.get('partialFilterExpression', {}).get('timestamp', {}).get('$gte')
+    if info.get('key') != STATS_INDEX or cutoff is None:
+        return refresh_recent_index(collection)
+    return cutoff
+
+def refresh_recent_index(collection, retention_days=MONGODB_INDEX_DAYS):
+    """
+    Rebuild the partial stats index with a fresh cutoff, so it only holds
+    recent readings; meant to be scheduled daily
     
-    print(f"\n🔍 Sensor Anomaly Detection Results")
-    print(f"{'='*70}")
-    print(f"Time Range: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
-    print(f"Sigma Threshold: {sigma_threshold}σ\n")
+    Args:
+        collection: MongoDB collection holding the sensor readings
+        retention_days (int): Number of days of readings kept in the index
+    
+    Returns:
+        datetime: Cutoff of the rebuilt index
+    """
+    # Runs that hint the index while it is being rebuilt fall back to an
+    # unhinted query (see aggregate_stats)
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    if STATS_INDEX_NAME in collection.index_information():
+        collection.drop_index(STATS_INDEX_NAME)
+    collection.create_index(
+        STATS_INDEX,
+        name=STATS_INDEX_NAME,
+        partialFilterExpression={'timestamp': {'$gte': cutoff}}
+    )
+    return cutoff
+
+def stats_index_hint(cutoff, start_date):
+    """
+    Pick the index to hint for a stats query starting at start_date
+    
+    Args:
+        cutoff (datetime): Cutoff of the partial stats index, as returned by
+            ensure_indexes
+        start_date (datetime): Start of the time range
+    
+    Returns:
+        str: The partial stats index name if it covers the whole range, else
+        None to leave the choice to the query planner
+    """
+    if cutoff is not None and start_date >= cutoff:
+        return STATS_INDEX_NAME
+    return None
+
+def build_stats_pipeline(start_date, end_date):
+    """
+    Build the aggregation pipeline computing per-sensor statistics
+    
+    Args:
+        start_date (datetime): Start of the time range
+        end_date (datetime): End of the time range
     
-    # MongoDB Aggregation Pipeline
-    pipeline = [
-        # Stage 1: Filter by date range
+    Returns:
+        list: Pipeline yielding one {_id, mean, stddev, count} document per sensor
+    """
+    return [
+        # Stage 1: Filter by date range (datetime bounds keep this an index scan)
         {
             '$match': {
                 'timestamp': {
@@ -47,133 +139,383 @@ def detect_anomalies(days_back=7, sigma_threshold=3):
             }
         },
         
-        # Stage 2: Group by sensor_id and calculate statistics
+        # Stage 2: Keep only the fields the statistics need
         {
-            '$group': {
-                '_id': '$sensor_id',
-                'readings': {'$push': '$$ROOT'},
-                'mean': {'$avg': '$value'},
-                'count': {'$sum': 1},
-                'values': {'$push': '$value'}
+            '$project': {
+                '_id': 0,
+                'sensor_id': 1,
+                'value': 1,
+                'timestamp': 1
             }
         },
         
-        # Stage 3: Calculate variance and standard deviation
+        # Stage 3: Group by sensor_id and calculate statistics
+        # ($stdDevPop is a native single-pass accumulator)
         {
-            '$addFields': {
-                'variance': {
-                    '$avg': {
-                        '$map': {
-                            'input': '$values',
-                            'as': 'val',
-                            'in': {
-                                '$pow': [
-                                    {'$subtract': ['$$val', '$mean']},
-                                    2
-                                ]
-                            }
-                        }
-                    }
-                }
+            '$group': {
+                '_id': '$sensor_id',
+                'mean': {'$avg': '$value'},
+                'stddev': {'$stdDevPop': '$value'},
+                'count': {'$sum': 1}
             }
         },
         
-        # Stage 4: Calculate standard deviation
+        # Stage 4: Sort by sensor_id
         {
-            '$addFields': {
-                'stddev': {'$sqrt': '$variance'}
-            }
-        },
-        
-        # Stage 5: Calculate threshold (mean + N * stddev)
+            '$sort': {'_id': 1}
+        }
+    ]
+
+def aggregate_stats(collection, pipeline, hint=None):
+    """
+    Run a statistics pipeline over the sensor readings
+    
+    Args:
+        collection: MongoDB collection holding the sensor readings
+        pipeline (list): Aggregation pipeline to execute
+        hint (str): Index to hint, retried without when the server rejects it
+    
+    Returns:
+        CommandCursor: Cursor over the pipeline output
+    """
+    # allowDiskUse lets $group/$sort spill to disk instead of failing at the
+    # 100MB stage limit
+    options = {'allowDiskUse': True, 'batchSize': MONGODB_BATCH_SIZE}
+    if hint is not None:
+        try:
+            return collection.aggregate(pipeline, hint=hint, **options)
+        except OperationFailure as e:
+            # The index may be mid-rebuild by refresh_recent_index
+            if e.code != BAD_VALUE:
+                raise
+    return collection.aggregate(pipeline, **options)
+
+def materialize_sensor_stats(days_back=7):
+    """
+    Precompute per-sensor statistics into the stats collection, replacing
+    its previous contents; meant to be scheduled (e.g. hourly)
+    
+    Args:
+        days_back (int): Number of days to look back
+    """
+    # Connect to MongoDB
+    client = get_client()
+    db = client[MONGODB_DATABASE]
+    collection = db[MONGODB_COLLECTION]
+    index_cutoff = ensure_indexes(collection)
+    
+    end_date = datetime.utcnow()
+    start_date = end_date - timedelta(days=days_back)
+    
+    pipeline = build_stats_pipeline(start_date, end_date)
+    pipeline.extend([
+        # Record the window the statistics describe and when they were computed
         {
             '$addFields': {
-                'threshold': {
-                    '$add': [
-                        '$mean',
-                        {'$multiply': [sigma_threshold, '$stddev']}
-                    ]
-                }
+                'start_date': start_date,
+                'end_date': end_date,
+                'computed_at': end_date
             }
         },
-        
-        # Stage 6: Filter readings that exceed threshold
-        {
-            '$addFields': {
-                'anomalies': {
-                    '$filter': {
-                        'input': '$readings',
-                        'as': 'reading',
-                        'cond': {
-                            '$gt': ['$$reading.value', '$threshold']
+        {'$out': MONGODB_STATS_COLLECTION}
+    ])
+    aggregate_stats(collection, pipeline, stats_index_hint(index_cutoff, start_date))
+
+def load_materialized_stats(stats_collection, days_back):
+    """
+    Read precomputed per-sensor statistics, if they match the requested window
+    
+    Args:
+        stats_collection: Collection written by materialize_sensor_stats
+        days_back (int): Number of days the statistics must cover
+    
+    Returns:
+        list: Statistics ordered by sensor_id, or None if the collection is
+        empty, was materialized over a different number of days, or is older
+        than MONGODB_STATS_MAX_AGE_HOURS
+    """
+    stats = list(stats_collection.find().sort('_id', 1))
+    if not stats or 'start_date' not in stats[0]:
+        return None
+    
+    # Stale statistics (e.g. the scheduled job stopped) describe a dead window
+    age = datetime.utcnow() - stats[0]['computed_at']
+    if age > timedelta(hours=MONGODB_STATS_MAX_AGE_HOURS):
+        return None
+    
+    # Stored datetimes are truncated to milliseconds, so allow a little slack
+    window = stats[0]['end_date'] - stats[0]['start_date']
+    if abs(window - timedelta(days=days_back)) > timedelta(seconds=1):
+        return None
+    return stats
+
+def server_side_results(collection, start_date, end_date, sigma_threshold, stats=None, hint=None):
+    """
+    Compute per-sensor statistics with a MongoDB aggregation and look up
+    the readings above each sensor's threshold
+    
+    Args:
+        collection: MongoDB collection holding the sensor readings
+        start_date (datetime): Start of the time range
+        end_date (datetime): End of the time range
+        sigma_threshold (float): Number of standard deviations for threshold
+        stats (list): Precomputed statistics for this window to use instead
+            of aggregating (see load_materialized_stats)
+        hint (str): Index to hint for the statistics aggregation
+    
+    Yields:
+        dict: Sensor statistics with its 'anomalies', ordered by sensor_id
+    """
+    # One small document per sensor, either precomputed or aggregated now
+    if stats is None:
+        stats = list(aggregate_stats(collection, build_stats_pipeline(start_date, end_date), hint))
+    
+    # Calculate threshold (mean + N * stddev)
+    for r in stats:
+        r['threshold'] = r['mean'] + sigma_threshold * r['stddev']
+    
+    # Stream only the readings above their sensor's threshold, grouped by sensor
+    anomaly_groups = iter(())
+    if stats:
+        anomaly_pipeline = [
+            {
+                '$match': {
+                    '$or': [
+                        {
+                            'sensor_id': r['_id'],
+                            'value': {'$gt': r['threshold']},
+                            'timestamp': {'$gte': start_date, '$lte': end_date}
                         }
-                    }
+                        for r in stats
+                    ]
+                }
+            },
+            
+            {
+                '$project': {
+                    '_id': 0,
+                    'sensor_id': 1,
+                    'value': 1,
+                    'timestamp': 1
                 }
+            },
+            
+            # Grouping key only; each sensor's anomalies are ranked by deviation
+            # client-side
+            {
+                '$sort': {'sensor_id': 1}
             }
-        },
+        ]
+        # The only query still growing with the data, so let its sort spill
+        cursor = collection.aggregate(anomaly_pipeline, allowDiskUse=True, batchSize=MONGODB_BATCH_SIZE)
+        anomaly_groups = groupby(cursor, key=itemgetter('sensor_id'))
+    next_group = next(anomaly_groups, None)
+    
+    for sensor_result in stats:
+        # Both queries are sorted by sensor_id, so groups line up with the stats
+        anomalies = []
+        if next_group is not None and next_group[0] == sensor_result['_id']:
+            anomalies = list(next_group[1])
+            next_group = next(anomaly_groups, None)
         
-        # Stage 7: Sort by sensor_id
-        {
-            '$sort': {'_id': 1}
+        # Deviation in sigmas, from the statistics already in memory
+        mean = sensor_result['mean']
+        stddev = sensor_result['stddev']
+        for anomaly in anomalies:
+            anomaly['deviation'] = (anomaly['value'] - mean) / stddev if stddev > 0 else 0
+        sensor_result['anomalies'] = anomalies
+        yield sensor_result
+
+def client_side_results(collection, start_date, end_date, sigma_threshold):
+    """
+    Compute per-sensor statistics locally with NumPy, for datasets that fit
+    in memory
+    
+    Args:
+        collection: MongoDB collection holding the sensor readings
+        start_date (datetime): Start of the time range
+        end_date (datetime): End of the time range
+        sigma_threshold (float): Number of standard deviations for threshold
+    
+    Yields:
+        dict: Sensor statistics with its 'anomalies', ordered by sensor_id
+    """
+    cursor = collection.find(
+        {'timestamp': {'$gte': start_date, '$lte': end_date}},
+        {'_id': 0, 'sensor_id': 1, 'value': 1, 'timestamp': 1}
+    )
+    
+    sensor_ids, values, timestamps = [], [], []
+    for reading in cursor:
+        sensor_ids.append(reading['sensor_id'])
+        values.append(reading['value'])
+        timestamps.append(reading['timestamp'])
+    
+    if not values:
+        return
+    
+    # Dictionary-encode sensor ids (sorted, matching the server-side order)
+    sensors, sensor_idx = np.unique(np.array(sensor_ids, dtype=object), return_inverse=True)
+    values = np.asarray(values, dtype=np.float64)
+    n_sensors = len(sensors)
+    
+    # Grouped sums in a single C-level pass per column
+    counts = np.bincount(sensor_idx, minlength=n_sensors)
+    sums = np.bincount(sensor_idx, weights=values, minlength=n_sensors)
+    means = sums / counts
+    
+    # Sum of squared deviations from each sensor's mean (M2), which unlike
+    # E[x^2] - E[x]^2 does not cancel catastrophically for large offsets
+    centered = values - means[sensor_idx]
+    m2 = np.bincount(sensor_idx, weights=centered * centered, minlength=n_sensors)
+    stddevs = np.sqrt(m2 / counts)
+    thresholds = means + sigma_threshold * stddevs
+    
+    # Flag anomalies and split their positions per sensor
+    anomaly_idx = np.flatnonzero(values > thresholds[sensor_idx])
+    anomaly_idx = anomaly_idx[np.argsort(sensor_idx[anomaly_idx], kind='stable')]
+    anomaly_sensors = sensor_idx[anomaly_idx]
+    deviations = np.zeros(len(values))
+    deviations[anomaly_idx] = np.divide(
+        values[anomaly_idx] - means[anomaly_sensors],
+        stddevs[anomaly_sensors],
+        out=np.zeros(len(anomaly_idx)),
+        where=stddevs[anomaly_sensors] > 0
+    )
+    anomaly_counts = np.bincount(anomaly_sensors, minlength=n_sensors)
+    per_sensor = np.split(anomaly_idx, np.cumsum(anomaly_counts)[:-1])
+    
+    for s, sensor_id in enumerate(sensors):
+        yield {
+            '_id': sensor_id,
+            'mean': float(means[s]),
+            'stddev': float(stddevs[s]),
+            'threshold': float(thresholds[s]),
+            'count': int(counts[s]),
+            'anomalies': [
+                {
+                    'sensor_id': sensor_id,
+                    'value': float(values[i]),
+                    'timestamp': timestamps[i],
+                    'deviation': float(deviations[i])
+                }
+                for i in per_sensor[s]
+            ]
         }
-    ]
+
+def detect_anomalies(days_back=7, sigma_threshold=3, client_side=False, use_materialized_stats=False,
+                     collect_results=True):
+    """
+    Detect anomalies in sensor data using 3-sigma rule
+    
+    Args:
+        days_back (int): Number of days to look back
+        sigma_threshold (float): Number of standard deviations for threshold
+        client_side (bool): Compute statistics locally instead of in MongoDB
+        use_materialized_stats (bool): Read statistics precomputed by
+            materialize_sensor_stats, and look up anomalies over the window
+            they were computed for; falls back to aggregating live when none
+            exist for a days_back-day window or they are stale
+        collect_results (bool): Keep every sensor's statistics and anomalies
+            for the return value; pass False so the server-side path holds
+            only one sensor's anomalies in memory at a time
+    
+    Returns:
+        list: Per-sensor statistics with their 'anomalies', or None when
+        collect_results is False
+    """
+    # Connect to MongoDB
+    client = get_client()
+    db = client[MONGODB_DATABASE]
+    collection = db[MONGODB_COLLECTION]
+    index_cutoff = ensure_indexes(collection)
+    
+    # Calculate date range
+    end_date = datetime.utcnow()
+    start_date = end_date - timedelta(days=days_back)
+    
+    # Precomputed statistics replace the live window with the one they cover
+    stats = None
+    if use_materialized_stats and not client_side:
+        stats = load_materialized_stats(db[MONGODB_STATS_COLLECTION], days_back)
+        if stats is None:
+            print(f"\n⚠️  No fresh materialized statistics for a {days_back}-day window, aggregating live")
+        else:
+            start_date = stats[0]['start_date']
+            end_date = stats[0]['end_date']
+    
+    print(f"\n🔍 Sensor Anomaly Detection Results")
+    print(f"{'='*70}")
+    print(f"Time Range: {start_date.date().isoformat()} to {end_date.date().isoformat()}")
+    if stats is not None:
+        print(f"Statistics: materialized at {stats[0]['computed_at'].isoformat(sep=' ', timespec='seconds')}")
+    print(f"Sigma Threshold: {sigma_threshold}σ\n")
     
-    # Execute aggregation
-    results = list(collection.aggregate(pipeline))
+    if client_side:
+        sensor_results = client_side_results(collection, start_date, end_date, sigma_threshold)
+    else:
+        hint = stats_index_hint(index_cutoff, start_date)
+        sensor_results = server_side_results(collection, start_date, end_date, sigma_threshold,
+                                             stats, hint)
     
-    # Display results
+    # Display results as each sensor's anomalies arrive
+    results = [] if collect_results else None
     total_anomalies = 0
+    sensor_count = 0
     
-    for sensor_result in results:
+    for sensor_result in sensor_results:
+        sensor_count += 1
+        if collect_results:
+            results.append(sensor_result)
         sensor_id = sensor_result['_id']
+        anomalies = sensor_result['anomalies']
         mean = sensor_result['mean']
         stddev = sensor_result['stddev']
         threshold = sensor_result['threshold']
         count = sensor_result['count']
-        anomalies = sensor_result['anomalies']
         
-        print(f"📊 Sensor: {sensor_id}")
-        print(f"   Readings: {count}")
-        print(f"   Mean: {mean:.2f} | Std Dev: {stddev:.2f} | Threshold ({sigma_threshold}σ): {threshold:.2f}")
+        # Buffer the sensor's block and write it with a single print
+        lines = [
+            f"📊 Sensor: {sensor_id}",
+            f"   Readings: {count}",
+            f"   Mean: {mean:.2f} | Std Dev: {stddev:.2f} | Threshold ({sigma_threshold}σ): {threshold:.2f}"
+        ]
         
-        if anomalies:
-            print(f"   🚨 Found {len(anomalies)} anomalies:")
-            total_anomalies += len(anomalies)
+        num_anomalies = len(anomalies)
+        if num_anomalies:
+            lines.append(f"   🚨 Found {num_anomalies} anomalies:")
+            total_anomalies += num_anomalies
             
-            # Sort anomalies by deviation (highest first)
-            sorted_anomalies = sorted(
-                anomalies,
-                key=lambda x: (x['value'] - mean) / stddev if stddev > 0 else 0,
-                reverse=True
-            )
+            # Top 5 anomalies by deviation (highest first)
+            top_anomalies = heapq.nlargest(5, anomalies, key=itemgetter('deviation'))
             
-            for anomaly in sorted_anomalies[:5]:  # Show top 5
+            for anomaly in top_anomalies:
                 value = anomaly['value']
                 timestamp = anomaly['timestamp']
-                deviation = (value - mean) / stddev if stddev > 0 else 0
+                deviation = anomaly['deviation']
                 
-                print(f"      • {timestamp.strftime('%Y-%m-%d %H:%M:%S')} | "
-                      f"Value: {value:.2f} | Deviation: {deviation:.2f}σ")
+                lines.append(f"      • {timestamp.isoformat(sep=' ', timespec='seconds')} | "
+                             f"Value: {value:.2f} | Deviation: {deviation:.2f}σ")
             
-            if len(anomalies) > 5:
-                print(f"      ... and {len(anomalies) - 5} more")
+            remaining = num_anomalies - len(top_anomalies)
+            if remaining:
+                lines.append(f"      ... and {remaining} more")
         else:
-            print(f"   ✅ No anomalies detected")
+            lines.append(f"   ✅ No anomalies detected")
         
-        print()    
+        lines.append('')
+        print('\n'.join(lines))
+    
     # Summary
     print(f"{'='*70}")
-    print(f"📈 Summary: {total_anomalies} total anomalies detected across {len(results)} sensors")
+    print(f"📈 Summary: {total_anomalies} total anomalies detected across {sensor_count} sensors")
     print(f"{'='*70}\n")
     
-    # Close connection
-    client.close()
-    
     return results
 
 if __name__ == '__main__':
     try:
-        detect_anomalies(days_back=7, sigma_threshold=3)
+        detect_anomalies(days_back=7, sigma_threshold=3, collect_results=False)
     except Exception as e:
         print(f"❌ Error: {e}")
         print("\nMake sure:")
@@ -4,18 +4,18 @@ Generate sample sensor data for testing anomaly detection
 """
 
 import os
-import random
-from datetime import datetime, timedelta
-from pymongo import MongoClient
+from datetime import datetime
+import numpy as np
 from dotenv import load_dotenv
+from anomaly_detection import MONGODB_STATS_COLLECTION, ensure_indexes, get_client
 
 # Load environment variables
 load_dotenv()
 
 # MongoDB Configuration
-MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
 MONGODB_DATABASE = os.getenv('MONGODB_DATABASE', 'sensor_db')
 MONGODB_COLLECTION = os.getenv('MONGODB_COLLECTION', 'sensor_readings')
+INSERT_BATCH_SIZE = 1000
 
 def generate_sample_data(num_readings=500, anomaly_rate=0.05):
     """
@@ -26,12 +26,15 @@ def generate_sample_data(num_readings=500, anomaly_rate=0.05):
         anomaly_rate (float): Percentage of readings that should be anomalies (0.0 to 1.0)
     """
     # Connect to MongoDB
-    client = MongoClient(MONGODB_URI)
+    client = get_client()
     db = client[MONGODB_DATABASE]
     collection = db[MONGODB_COLLECTION]
     
-    # Clear existing data
+    # Clear existing data (indexes are dropped for the bulk load and rebuilt after)
+    collection.drop_indexes()
     collection.delete_many({})
+    # Materialized statistics describe the old readings
+    db.drop_collection(MONGODB_STATS_COLLECTION)
     print(f"🗑️  Cleared existing data from {MONGODB_COLLECTION}")
     
     # Sensor definitions (realistic sensor types)
@@ -43,71 +46,83 @@ def generate_sample_data(num_readings=500, anomaly_rate=0.05):
         {'id': 'sensor_005', 'type': 'light', 'base': 350, 'unit': 'lux', 'location': 'Room C'}
     ]
     
-    readings = []
     now = datetime.utcnow()
+    bases = np.array([sensor['base'] for sensor in sensors], dtype=np.float64)
+    rng = np.random.default_rng()
     
     print(f"\n📊 Generating {num_readings} sensor readings...")
     print(f"🎯 Target anomaly rate: {anomaly_rate * 100:.1f}%\n")
     
-    for i in range(num_readings):
-        # Random sensor
-        sensor = random.choice(sensors)
-        
-        # Random timestamp within last 10 days
-        days_ago = random.uniform(0, 10)
-        timestamp = now - timedelta(days=days_ago)
-        
-        # Generate value (normal with some variation)
-        base_value = sensor['base']
-        variation = base_value * 0.1  # 10% variation
-        value = base_value + random.uniform(-variation, variation)
-        
-        # Introduce anomalies
-        if random.random() < anomaly_rate:
-            # Make it 50-100% higher than base (guaranteed anomaly)
-            value = base_value + (base_value * random.uniform(0.5, 1.0))
-        
-        reading = {
-            'sensor_id': sensor['id'],
-            'sensor_type': sensor['type'],
-            'value': round(value, 2),
-            'unit': sensor['unit'],
-            'location': sensor['location'],
-            'timestamp': timestamp
-        }
-        
-        readings.append(reading)
+    # Random sensor (readings are held as sensor index/value/timestamp columns)
+    sensor_idx = rng.integers(0, len(sensors), size=num_readings, dtype=np.int8)
     
-    # Insert into MongoDB
-    result = collection.insert_many(readings)
+    # Random timestamp within last 10 days
+    days_ago = rng.uniform(0, 10, size=num_readings)
+    timestamps = np.datetime64(now, 'us') - (days_ago * 86400e6).astype('timedelta64[us]')
+    
+    # Generate value (normal with some variation)
+    base_values = bases[sensor_idx]
+    variation = base_values * 0.1  # 10% variation
+    values = base_values + rng.uniform(-variation, variation)
+    
+    # Introduce anomalies
+    anomaly_mask = rng.random(num_readings) < anomaly_rate
+    # Make it 50-100% higher than base (guaranteed anomaly)
+    values[anomaly_mask] = base_values[anomaly_mask] * (1 + rng.uniform(0.5, 1.0, size=anomaly_mask.sum()))
+    values = np.round(values, 2)
+    
+    # Insert into MongoDB in unordered batches, building documents per batch
+    inserted = 0
+    for start in range(0, num_readings, INSERT_BATCH_SIZE):
+        stop = start + INSERT_BATCH_SIZE
+        readings = [
+            {
+                'sensor_id': sensors[s]['id'],
+                'sensor_type': sensors[s]['type'],
+                'value': value,
+                'unit': sensors[s]['unit'],
+                'location': sensors[s]['location'],
+                'timestamp': timestamp
+            }
+            for s, value, timestamp in zip(
+                sensor_idx[start:stop].tolist(),
+                values[start:stop].tolist(),
+                timestamps[start:stop].tolist()
+            )
+        ]
+        result = collection.insert_many(readings, ordered=False)
+        inserted += len(result.inserted_ids)
+    
+    ensure_indexes(collection)
     
     # Print summary
-    print(f"✅ Successfully inserted {len(result.inserted_ids)} readings\n")
+    print(f"✅ Successfully inserted {inserted} readings\n")
+    
+    # Show sensor summary (count/sum/min/max in a single pass over the columns)
+    counts = np.bincount(sensor_idx, minlength=len(sensors))
+    sums = np.bincount(sensor_idx, weights=values, minlength=len(sensors))
+    mins = np.full(len(sensors), np.inf)
+    maxs = np.full(len(sensors), -np.inf)
+    np.minimum.at(mins, sensor_idx, values)
+    np.maximum.at(maxs, sensor_idx, values)
     
-    # Show sensor summary
     print("📈 Sensor Summary:")
     print(f"{'='*60}")
-    for sensor in sensors:
-        sensor_readings = [r for r in readings if r['sensor_id'] == sensor['id']]
-        values = [r['value'] for r in sensor_readings]
-        
-        if values:
-            mean = sum(values) / len(values)
-            min_val = min(values)
-            max_val = max(values)
+    for s, sensor in enumerate(sensors):
+        if counts[s]:
+            mean = sums[s] / counts[s]
+            min_val = mins[s]
+            max_val = maxs[s]
             
             print(f"{sensor['id']} ({sensor['type']})")
             print(f"  Location: {sensor['location']}")
-            print(f"  Readings: {len(sensor_readings)}")
+            print(f"  Readings: {counts[s]}")
             print(f"  Range: {min_val:.2f} - {max_val:.2f} {sensor['unit']}")
             print(f"  Mean: {mean:.2f} {sensor['unit']}\n")
     
     print(f"{'='*60}")
     print(f"\n✨ Sample data generation complete!")
     print(f"\n💡 Next step: Run 'python anomaly_detection.py' to detect anomalies\n")
-    
-    # Close connection
-    client.close()
 
 if __name__ == '__main__':
     try:
@@ -117,4 +132,4 @@ if __name__ == '__main__':
         print("\nMake sure:")
         print("1. MongoDB is running")
         print("2. .env file is configured correctly")
-        print("3. pymongo is installed: pip install pymongo python-dotenv")
\ No newline at end of file
+        print("3. pymongo is installed: pip install pymongo python-dotenv numpy")
\ No newline at end of file